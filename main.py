@@ -20,46 +20,73 @@ import math
 import numpy as np
 from csv import QUOTE_ALL
 from datetime import datetime
+from functools import lru_cache, partial
 from argparse import ArgumentParser
-from ast import literal_eval
-from dateparser import parse as dateparse
-from json import loads as json_decode
+from concurrent.futures import ThreadPoolExecutor
 from mechanicalsoup import StatefulBrowser
 from os.path import join as path_join
+from pandas.api.types import (is_datetime64_any_dtype, is_float_dtype,
+                              is_integer_dtype)
 from rdflib import Graph
+from shutil import copyfileobj
+from threading import Lock
 from re import compile as re_compile
 from requests import get as requests_get
-from xml.etree import ElementTree as et
 from zipfile import ZipFile
 
-# hide pandas warnings (all warnings in general)
+# orjson decoder is way faster, fallback to the standard one
+try:
+    from orjson import loads as json_decode
+except ImportError:
+    from json import loads as json_decode
+
+# lxml parser is way faster, fallback to the standard one
+try:
+    from lxml import etree as et
+except ImportError:
+    from xml.etree import ElementTree as et
+
+# hide only known noisy warnings, catch_warnings is not thread safe
+# so the filters are registered once here
 import warnings
-warnings.filterwarnings('ignore')
+warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+warnings.filterwarnings('ignore', category=FutureWarning,
+                        message='Downcasting behavior in `replace`')
 
 
 ALLOWED_EXTS = ('xls', 'xlsx', 'json', 'xml', 'rdf')
 ERROR_FILE_NAME = 'bad_files.txt'
 SAMPLE_DATA = 150
+MAX_WORKERS = 8
+CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
 date_expected_format = re_compile(r"^\d{2}(?:\/|\-)\d{2}(?:\/|\-)(?:\d{4}|\d{2})$")
-
-def is_valid_date(str_date):
-    return (date_expected_format
-                .match(str_date) is not None
-        )
+int_expected_format = re_compile(r"^[-+]?(?:0|[1-9]\d*)$")
+float_expected_format = re_compile(r"^[-+]?(?:(?:0|[1-9]\d*)(?:\.\d*)?|\.\d+)"
+                                   r"(?:[eE][-+]?\d+)?$")
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%d-%m", "%m-%d-%Y", "%m-%d-%y",
+                "%d-%m-%Y", "%Y/%m/%d", "%Y/%d/%m", "%m/%d/%Y",
+                "%m/%d/%y", "%d/%m/%Y", "%Y.%m.%d", "%Y.%d.%m",
+                "%m.%d.%Y", "%d.%m.%Y")
+TYPE_PRIORITY = (('str', 'VARCHAR'), ('float', 'DECIMAL'), ('int', 'INT'))
+SANITY_TABLE = str.maketrans('', '', r'\/:?*|"')
+log_lock = Lock()
+output_names = set()
+output_names_lock = Lock()
 
 def dataframe_from_json(filename):
     try:
-        # the file must be opened and parsed into a dict
-        with open(filename) as f: json = json_decode(f.read())
+        # the file must be opened and parsed into a dict,
+        # raw bytes are decoded directly, without an intermediate str
+        with open(filename, 'rb') as f: payload = json_decode(f.read())
 
         # extract the data attribute
-        rows = json['data']
+        rows = payload['data']
         # extract the columns meta data
-        columns = json['meta']['view']['columns']
+        columns = payload['meta']['view']['columns']
         # columns names in meta data
-        column_names = list(map(lambda c: c['name'], columns))
+        column_names = [c['name'] for c in columns]
         # finally, create the dataframe
-        dataframe = pandas.DataFrame(rows, columns=column_names)
+        dataframe = pandas.DataFrame.from_records(rows, columns=column_names)
         return dataframe
     except Exception as e:
         return None
@@ -67,29 +94,54 @@ def dataframe_from_json(filename):
 
 def dataframe_from_xml(filename):
 
+    # read_xml loads the whole document in memory, the streaming
+    # reader is only used where read_xml is not supported
     try:
-        # read the xml file
-        xtree = et.parse(filename)
-        # get the root node
-        xroot = xtree.getroot()[0]
-
-        dataframe = pandas.DataFrame()
-
-        # iterate for root node children
-        for node in xroot:
-            row = []
-            for elem in node.getchildren():
-                if elem is not None:
-                    row.append(elem.text)
-
-            # extract tags from nodes
-            df_cols = list(map(lambda c: c.tag, node.getchildren()))
-            # create pandas serie with nodes row
-            pd_serie = pandas.Series(row, index=df_cols)
-            # add row to dataframe
-            dataframe = dataframe.append(pd_serie, ignore_index = True)
+        # rows are the children of the first node under the root
+        return pandas.read_xml(filename, xpath='/*/*[1]/*', parser='lxml',
+                               elems_only=True, dtype=str)
+    except (AttributeError, TypeError, ImportError) as e:
+        # no read_xml (pandas < 1.3), no dtype (pandas < 1.5)
+        # or lxml not installed, parse it by hand
+        return dataframe_from_xml_stream(filename)
+    except Exception as e:
+        return None
 
-        return dataframe
+
+def dataframe_from_xml_stream(filename):
+
+    try:
+        rows = []
+        depth = 0
+
+        # stream the xml file, rows are the children
+        # of the first node under the root
+        for event, elem in et.iterparse(filename, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+
+            if depth == 3:
+                # map each child tag to its text,
+                # comments and processing instructions are skipped
+                row_dict = {child.tag: child.text for child in elem
+                            if isinstance(child.tag, str)}
+                rows.append(row_dict)
+
+                # free the processed row
+                elem.clear()
+                if hasattr(elem, 'getprevious'):
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+
+            elif depth == 2:
+                # first node under the root is done, ignore the rest
+                break
+
+            depth -= 1
+
+        # build the dataframe at once
+        return pandas.DataFrame(rows)
     except Exception as e:
         return None
 
@@ -108,32 +160,25 @@ def dataframe_from_rfd(filename):
         return None
 
 
+READERS = {
+    'xlsx': partial(pandas.read_excel, dtype=str),
+    'xls': partial(pandas.read_excel, dtype=str),
+    'csv': partial(pandas.read_csv, dtype=str),
+    'xml': dataframe_from_xml,
+    'json': dataframe_from_json,
+    'rdf': dataframe_from_rfd,
+}
+
+
 def read_file(filename):
     '''
         Given the input file, generate a dataframe depeding on the file type
     '''
 
-    file_type = filename.rpartition('.')[-1]
-
-    if file_type in ('xlsx', 'xls') :
-        dataframe = pandas.read_excel(filename, dtype=str)
-
-    elif file_type == 'csv':
-        dataframe = pandas.read_csv(filename, dtype=str)
+    file_type = os.path.splitext(filename)[1].lstrip('.').lower()
+    reader = READERS.get(file_type)
 
-    elif file_type == 'xml':
-        dataframe = dataframe_from_xml(filename)
-
-    elif file_type == 'json':
-        dataframe = dataframe_from_json(filename)
-
-    elif file_type == 'rdf':
-        dataframe = dataframe_from_rfd(filename)
-
-    else:
-        dataframe = None
-
-    return dataframe
+    return reader(filename) if reader is not None else None
 
 
 def export_csv(dataframe, output_name):
@@ -145,23 +190,42 @@ def export_csv(dataframe, output_name):
 
 
 def choose_type_priority(types):
-    if 'str' in types:
-        return 'VARCHAR'
+    '''
+        Given the set of guessed types, choose the sql type
+        with the highest priority.
+    '''
+    sql_type = next((sql for name, sql in TYPE_PRIORITY if name in types), None)
 
-    elif 'float' in types:
-        return 'DECIMAL'
+    if sql_type is not None:
+        return sql_type
 
-    elif 'int' in types:
-        return 'INT'
+    val = next((x for x in types if 'format' in x), None)
 
-    elif any(['format' in str(x) for x in types]):
-        val = next((x for x in types if 'format' in x), '')
+    if val is not None:
         return f'DATETIME {val}'
 
     else:
         return 'VARCHAR'
 
 
+def dtype_to_sql_type(dtype):
+    '''
+        Get the sql type of an already typed column,
+        object columns must be guessed from its values.
+    '''
+    if is_integer_dtype(dtype):
+        return 'INT'
+
+    elif is_float_dtype(dtype):
+        return 'DECIMAL'
+
+    elif is_datetime64_any_dtype(dtype):
+        return 'DATETIME'
+
+    else:
+        return None
+
+
 def to_sql_field(type, field_max=None):
     '''
         The columns may look having multple types
@@ -173,29 +237,41 @@ def to_sql_field(type, field_max=None):
     return f'{type} {precision}'
 
 
-def guess_str_type(value):
+def guess_serie_types(serie):
     '''
-        based in the given value, guess the value type
+        based in the given serie values, guess the values types
     '''
 
-    _str = str(value).strip()
+    # null values (NaN or None) don't tell anything about the type
+    values = serie.dropna().astype(str).str.strip()
+    values = values[values != 'None']
 
-    try:
-        # if 'nan' is received (the numpy None value)
-        # there's nothing to do
-        if _str == 'nan':
-            return 'str'
-        elif is_valid_date(_str):
-            return f"format '{str_to_frmt(_str)}'"
-    except Exception as e:
-        pass
+    # date shaped values are not numbers
+    date_mask = values.str.match(date_expected_format)
+    dates = values[date_mask]
+    values = values[~date_mask]
 
-    try:
-        # trying to figure out value data type
-        return type(literal_eval(_str)).__name__
-    except Exception as e:
-        # can't cast? we assume it as string
-        return 'str'
+    # trying to figure out numeric values, leading zeros (zip codes)
+    # and inf/nan like values are kept as strings
+    int_mask = values.str.match(int_expected_format)
+    float_mask = values.str.match(float_expected_format) & ~int_mask
+
+    # can't cast? we assume it as string
+    if not (int_mask | float_mask).all():
+        return {'str'}
+
+    types = set()
+
+    # only date shaped values are checked against the date formats
+    for value in dates.drop_duplicates():
+        types.add(f"format '{str_to_frmt(value)}'")
+
+    if int_mask.any():
+        types.add('int')
+    if float_mask.any():
+        types.add('float')
+
+    return types
 
 
 def decimal_frmt(value):
@@ -222,14 +298,20 @@ def identify_colummns_types(dataframe):
     df_partial = dataframe[:SAMPLE_DATA]
 
     for column in df_partial:
-        # get types
-        types = df_partial[column].apply(lambda x: guess_str_type(x)) \
-                                  .drop_duplicates() \
-                                  .to_list()
+        precision = max_lenght = None
+
+        # typed columns don't need to be guessed
+        type_ = dtype_to_sql_type(df_partial[column].dtype)
+
+        if type_ is None:
+            # get types
+            types = guess_serie_types(df_partial[column])
+            type_ = choose_type_priority(types)
 
         try:
             values = list(df_partial[column]
                             .fillna('0')
+                            .astype(str)
                             .sort_values(ascending=False)
                         )
 
@@ -241,8 +323,6 @@ def identify_colummns_types(dataframe):
         except Exception as e:
             pass
 
-        type_ = choose_type_priority(types)
-
         if type_ == 'DECIMAL':
             try:
                 precision = decimal_frmt(max_value)
@@ -274,11 +354,13 @@ def identify_colummns_types(dataframe):
 
 def filename_and_ext(filename):
     '''
-        Split filename in basename and extension
+        Split filename in basename and lowercase extension
     '''
 
     base = os.path.basename(filename)
-    return base.split('.')[:1] + base.split('.')[-1:]
+    stem, dot, ext = base.rpartition('.')
+    # dotless and hidden (.name) files don't have extension
+    return (stem, ext.lower()) if dot and stem else (base, '')
 
 
 def write_sql(dataframe, filename):
@@ -292,16 +374,25 @@ def write_sql(dataframe, filename):
         f.write(sql)
 
 
-def single_file(search_tag, filename):
+def single_file(search_tag, filename, regex=False):
     '''
         Get files with filename included.
 
         Because in the page could appear same file name multiple times,
         we will get all files with same file name.
+
+        If regex is given, filename is used as a regular expression.
     '''
 
     filename = str(filename)
-    root = search_tag.find_all('a', {'title': re_compile(filename)})
+
+    if regex:
+        title_matcher = re_compile(filename)
+    else:
+        def title_matcher(value):
+            return value is not None and filename in value
+
+    root = search_tag.find_all('a', {'title': title_matcher})
     urls = list()
 
     # iterate over the page content
@@ -309,13 +400,13 @@ def single_file(search_tag, filename):
         li = elem.find_parent('li')
         data_format = elem.parent.find('span').attrs['data-format']
 
-        name = li.find('a', {'class' : 'heading'}) \
-                     .find(text=True) \
-                     .strip() \
-                     .replace(' ', '_')
+        name = li.select_one('a.heading') \
+                 .find(string=True) \
+                 .strip() \
+                 .replace(' ', '_')
 
-        url = li.find('i', { 'class' : 'icon-download-alt'}) \
-                  .parent.attrs['href']
+        url = li.select_one('i.icon-download-alt') \
+                .parent.attrs['href']
 
         if name == '':
             name = filename.strip().replace(' ', '_')
@@ -331,29 +422,35 @@ def many_files(search_tag):
         Get all file urls in the page body
     '''
     urls = list()
-    for elem in search_tag.find_all('i', { 'class' : 'icon-download-alt'}):
-        root = elem.find_parent('li')
-        name = root.find('a', {'class' : 'heading'}) \
-                     .find(text=True) \
-                     .strip() \
-                     .replace(' ', '_')
-
-        # get file extension
-        data_format = elem.parent.attrs['data-format']
-        # download url
-        url = elem.parent.attrs['href']
-
-        # the file extension is often included
-        # if not, then add it
-        if f'.{data_format}' not in name:
-            name = f'{name}.{data_format}'
+    for root in search_tag.select('li'):
+        icons = root.select('i.icon-download-alt')
+        if not icons:
+            continue
 
-        urls.append((name, url))
+        heading = root.select_one('a.heading') \
+                      .find(string=True) \
+                      .strip() \
+                      .replace(' ', '_')
+
+        # one file per download icon
+        for elem in icons:
+            # get file extension
+            data_format = elem.parent.attrs['data-format']
+            # download url
+            url = elem.parent.attrs['href']
+
+            # the file extension is often included
+            # if not, then add it
+            name = heading
+            if f'.{data_format}' not in name:
+                name = f'{name}.{data_format}'
+
+            urls.append((name, url))
 
     return urls
 
 
-def retreive_download_url(url, filename=None):
+def retreive_download_url(url, filename=None, regex=False):
     '''
         Retrieve files url from page body.
 
@@ -370,7 +467,7 @@ def retreive_download_url(url, filename=None):
         if filename is None:
             urls = many_files(search_tag)
         else:
-            urls = single_file(search_tag, filename)
+            urls = single_file(search_tag, filename, regex)
         return title, urls
 
     except Exception as e:
@@ -382,18 +479,21 @@ def download_file(destine, filename, url):
         Download file from url and place it in given path.
     '''
 
-    response = requests_get(url, stream=True)
     f_path = path_join(destine, filename)
 
-    # we expect a different content type
-    if 'text/html' in response.headers.get('Content-Type', 'text/html') :
-        return False
+    with requests_get(url, stream=True) as response:
+        # dead links are logged as bad files
+        if not response.ok:
+            return False
 
-    # write file by chunks
-    f = open(f_path, 'wb')
-    for chunk in response.iter_content(chunk_size=1024):
-        f.write(chunk)
-    f.close()
+        # we expect a different content type
+        if 'text/html' in response.headers.get('Content-Type', 'text/html') :
+            return False
+
+        # write file by chunks
+        response.raw.decode_content = True
+        with open(f_path, 'wb') as f:
+            copyfileobj(response.raw, f, length=CHUNK_SIZE)
 
     return True
 
@@ -403,11 +503,8 @@ def create_folder_structure(root_folder_name):
         Given the page title, create the folder structure to save the results.
     '''
 
-    if not os.path.exists(root_folder_name):
-        os.mkdir(root_folder_name)
-        os.mkdir(path_join(root_folder_name, 'download'))
-        os.mkdir(path_join(root_folder_name, 'csv'))
-        os.mkdir(path_join(root_folder_name, 'sql'))
+    for sub_folder in ('download', 'csv', 'sql'):
+        os.makedirs(path_join(root_folder_name, sub_folder), exist_ok=True)
 
 
 def arguments():
@@ -418,16 +515,29 @@ def arguments():
                                      ' and convert them to csv')
     parser.add_argument('url', type=str, help='site url')
     parser.add_argument('--filename', '-f', nargs='?',
-                        help='specify filename pattern to download')
+                        help='specify filename to download')
+    parser.add_argument('--regex', '-r', action='store_true',
+                        help='use filename as a regular expression')
+    parser.add_argument('--workers', '-w', type=int, default=MAX_WORKERS,
+                        help='number of files processed at the same time')
 
     return parser.parse_args()
 
 
+def log(message):
+    '''
+        Print message, files are processed by many threads
+    '''
+    with log_lock:
+        print(message)
+
+
 def log_unssuported(title, filename):
-    with open(ERROR_FILE_NAME, 'a+') as f:
-        f.write(filename)
-        f.write('\n')
-    print(f'\t # Bad File')
+    with log_lock:
+        with open(ERROR_FILE_NAME, 'a+') as f:
+            f.write(filename)
+            f.write('\n')
+    log(f'\t # Bad File "{filename}"')
 
 
 def process_zip(title, filename):
@@ -438,22 +548,22 @@ def process_zip(title, filename):
     # download folder
     dwn_dest = path_join(title, 'download')
 
-    f_zip = ZipFile(path_join(dwn_dest, filename))
     z_name, z_ext = filename_and_ext(filename)
 
     # create folder to extract
-    if not os.path.exists(path_join(dwn_dest, z_name)):
-        os.mkdir(path_join(dwn_dest, z_name))
-
+    extract_dir = path_join(dwn_dest, z_name)
+    os.makedirs(extract_dir, exist_ok=True)
 
-    # given each file..
-    for f_name in f_zip.namelist():
-        b_name, b_ext = filename_and_ext(f_name)
+    # extract valid files only..
+    with ZipFile(path_join(dwn_dest, filename)) as f_zip:
+        members = [f_name for f_name in f_zip.namelist()
+                   if filename_and_ext(f_name)[1] in ALLOWED_EXTS]
+        f_zip.extractall(extract_dir, members=members)
 
-        # .. if valid file, then extract it and process it
-        if b_ext in ALLOWED_EXTS:
-            f_zip.extract(f_name, path_join(dwn_dest, z_name))
-            process_file(title, path_join(dwn_dest, z_name, f_name))
+    # .. and process them
+    for f_name in members:
+        # relative to the download folder
+        process_file(title, path_join(z_name, f_name))
 
 
 def process_file(title, filename):
@@ -463,65 +573,123 @@ def process_file(title, filename):
 
     b_name, b_ext = filename_and_ext(filename)
 
-    # folders
-    csv_dest = path_join(title, 'csv')
-    sql_dest = path_join(title, 'sql')
     dwn_dest = path_join(title, 'download')
-
     df = read_file(path_join(dwn_dest, filename))
-    df = df.replace({'PrivacySuppressed': np.nan})
 
-    import ipdb; ipdb.set_trace(context=20)
     if df is not None:
-        print('\tExporting to csv')
-        export_csv(df, path_join(csv_dest, b_name))
+        df = df.replace({'PrivacySuppressed': np.nan})
+
+        # folders
+        csv_dest = path_join(title, 'csv')
+        sql_dest = path_join(title, 'sql')
+
+        # files with same name but different extension or zip folder
+        # are processed at the same time, so they can't share outputs
+        out_name = reserve_output_name(title, b_name)
 
-        print('\tExporting to sql')
-        write_sql(df, path_join(sql_dest, b_name))
+        log(f'\tExporting "{filename}" to csv')
+        export_csv(df, path_join(csv_dest, out_name))
+
+        log(f'\tExporting "{filename}" to sql')
+        write_sql(df, path_join(sql_dest, out_name))
 
     else:
         log_unssuported(title, filename)
 
 
+def reserve_output_name(title, name):
+    '''
+        Get an unused csv/sql output name for the given title,
+        adding an index to the repeated ones.
+    '''
+
+    with output_names_lock:
+        out_name = name
+        index = 1
+        while (title, out_name.lower()) in output_names:
+            out_name = f'{name}_{index}'
+            index += 1
+
+        output_names.add((title, out_name.lower()))
+
+    return out_name
+
+
+def process_download(title, file_info):
+    '''
+        Given the file name and url, download it and process it.
+    '''
+
+    dwn_dest = path_join(title, 'download')
+
+    f_name, url = file_info
+    b_name, b_ext = filename_and_ext(f_name)
+
+    log(f'Processing "{f_name}"')
+    log(f'\tDownloading "{f_name}"')
+    success = download_file(dwn_dest, f_name, url)
+
+    if success:
+        if b_ext == 'zip':
+            process_zip(title, f_name)
+        else:
+            process_file(title, f_name)
+    else:
+        log_unssuported(title, f_name)
+
+
+def unique_file_names(urls):
+    '''
+        Clean up the file names and add an index to the repeated ones,
+        so files processed at the same time don't overwrite each other.
+    '''
+
+    files = list()
+    seen = set()
+
+    for name, url in urls:
+        b_name, b_ext = filename_and_ext(sanity_name(name))
+        ext = f'.{b_ext}' if b_ext else ''
+        f_name = f'{b_name}{ext}'
+
+        index = 1
+        while f_name.lower() in seen:
+            f_name = f'{b_name}_{index}{ext}'
+            index += 1
+
+        seen.add(f_name.lower())
+        files.append((f_name, url))
+
+    return files
+
+
 def sanity_name(filename):
     '''
         Remove invalid characters for file name.
     '''
 
-    to_replace = r'\/:?*|"'
-    for chr_ in to_replace:
-        filename = filename.replace(chr_, '')
-    return filename
+    return filename.translate(SANITY_TABLE)
 
 
+@lru_cache(maxsize=None)
 def str_to_frmt(str):
     '''
         Based on a datetime, get the current date format,
         so 21/02/2019 is translated as dd/mm/yyyy
     '''
-    date_formats = ["%Y-%m-%d", "%Y-%d-%m", "%m-%d-%Y", "%m-%d-%y",
-                    "%d-%m-%Y", "%Y/%m/%d", "%Y/%d/%m", "%m/%d/%Y",
-                    "%m/%d/%y", "%d/%m/%Y", "%Y.%m.%d", "%Y.%d.%m",
-                    "%m.%d.%Y", "%d.%m.%Y"]
-    match = []
-    for fmt in date_formats:
+    for fmt in DATE_FORMATS:
         try:
             datetime.strptime(str, fmt)
         except ValueError as e:
             continue
 
-        match.append(fmt)
-        break
-
-    try:
-        date_fmt = match[0]
-        date_fmt = date_fmt.replace('%d', 'dd') \
-                           .replace('%Y', 'yyyy') \
-                           .replace('%y', 'yy') \
-                           .replace('%m', 'mm')
+        date_fmt = fmt.replace('%d', 'dd') \
+                      .replace('%Y', 'yyyy') \
+                      .replace('%y', 'yy') \
+                      .replace('%m', 'mm')
         return date_fmt
-    except Exception as e:
-        return None
+
+    return None
 
 
 def main():
@@ -529,30 +697,16 @@ def main():
 
     url = args.url
     filename = args.filename
-    title, urls = retreive_download_url(url, filename)
+    title, urls = retreive_download_url(url, filename, args.regex)
 
     title = sanity_name(title)
     create_folder_structure(title)
-    dwn_dest = path_join(title, 'download')
-
-    for file_info in urls:
+    urls = unique_file_names(urls)
 
-        f_name = sanity_name(file_info[0])
-        b_name, b_ext = filename_and_ext(f_name)
-        f_name = '.'.join([b_name, b_ext])
-        url = file_info[1]
-
-        print(f'\nProcessing "{f_name}"')
-        print('\tDownloading')
-        success = download_file(dwn_dest, f_name, url)
-
-        if success:
-            if b_ext == 'zip':
-                process_zip(title, f_name)
-            else:
-                process_file(title, f_name)
-        else:
-            log_unssuported(title, f_name)
+    # files are independent, so download and process them concurrently
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(lambda file_info: process_download(title, file_info),
+                          urls))
 
 
 if __name__ == '__main__':